@@ -18,12 +18,18 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import os
-import subprocess
 import sys
-import urllib3
-import requests
+
+from concurrent import futures
+
+from library_submodules import debug
 from library_submodules import reset_branches
-from library_submodules import label_exists
+from library_submodules import SESSION
+from library_submodules import TIMEOUT
+from library_submodules import get_github_json_list
+from library_submodules import GH_API_PULLS
+from library_submodules import GH_PULL_PATCH
+from library_submodules import get_pull_request_state
 from library_submodules import get_git_root
 from library_submodules import git_fetch
 from library_patch_submodules import library_patch_submodules
@@ -33,8 +39,32 @@ from library_patch_submodules import library_clean_submodules
 __dir__ = os.path.dirname(__file__)
 
 
+def download_patch(repo_name, pull_request_id, external_path):
+    patch_request = SESSION.get(
+        GH_PULL_PATCH.format(repo_name, pull_request_id),
+        stream=True,
+        timeout=TIMEOUT)
+    with patch_request:
+        if patch_request.status_code != 200:
+            return None
+
+        patchfile = '{0}/{1}.patch'.format(external_path, pull_request_id)
+        with open(patchfile, 'wb') as f:
+            for chunk in patch_request.iter_content(chunk_size=64 * 1024):
+                f.write(chunk)
+    return patchfile
+
+
+def read_file(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
 def handle_pull_requests(args):
-    print(args)
+    debug(args)
     assert len(args) == 6
     dmp = args.pop(0)
     repo_name = args.pop(0)
@@ -49,57 +79,92 @@ def handle_pull_requests(args):
     git_root = get_git_root()
 
     git_fetch(git_root)
-    r = requests.get(
-        'https://api.github.com/repos/{0}/pulls?state=open'.format(
-            repo_name))
-    all_open_pull_requests = \
-        sorted(list(set([str(item['number']) for item in r.json()])))
-    pr_hash_list = subprocess.check_output(
-        "git ls-remote origin 'pull/*/head'",
-        shell=True).decode('utf-8').split('\n')
+    open_pull_requests = get_github_json_list(
+        GH_API_PULLS.format(repo_name), access_token)
+    # Sort numerically, so that #10 is handled after #9.
+    all_open_pull_requests = [
+        str(number)
+        for number in sorted({item['number'] for item in open_pull_requests})]
+    pull_request_labels = {
+        str(item['number']): set(label['name'] for label in item['labels'])
+        for item in open_pull_requests}
+    pull_request_heads = {
+        str(item['number']): item['head']['sha']
+        for item in open_pull_requests}
     print("All Open Pull Requests: ", all_open_pull_requests)
-    library_clean_submodules(all_open_pull_requests)
-    for pull_request_id in all_open_pull_requests:
-        print()
-        print("Processing:", str(pull_request_id))
-        print('-'*20, flush=True)
-        commit_hash = ''
-        for pr_hash in pr_hash_list:
-            if 'pull/{0}/head'.format(pull_request_id) in pr_hash:
-                commit_hash = pr_hash.split()[0]
-                break
-        print("head commit hash: ", commit_hash)
-        print()
-        print("Getting Patch")
-        print()
-        http = urllib3.PoolManager()
-        patch_request = \
-            http.request('GET',
-                         'https://github.com/{0}/pull/{1}.patch'
-                         .format(repo_name, pull_request_id))
-        if patch_request.status != 200:
-            print('Unable to get patch. Skipping...')
-            continue
-
-        patchfile = '{0}/{1}.patch'.format(external_path, pull_request_id)
-        with open(patchfile, 'w') as f:
-            f.write(patch_request.data.decode('utf-8'))
-        print("Will try to apply: ", patchfile)
-
-        if library_patch_submodules(
-                patchfile, pull_request_id, repo_name, access_token,
-                commit_hash):
+    library_clean_submodules(all_open_pull_requests, external_path)
+    # Applying a pull request to every version branch is by far the slowest
+    # step, skip it when neither the pull request, the branches it is applied
+    # to nor its backport branches have moved since the last time it was
+    # handled.
+    statefiles = {
+        pull_request_id: '{0}/{1}.state'.format(external_path, pull_request_id)
+        for pull_request_id in all_open_pull_requests}
+    unchanged = {
+        pull_request_id
+        for pull_request_id in all_open_pull_requests
+        if read_file(statefiles[pull_request_id]) == get_pull_request_state(
+            git_root, pull_request_id, pull_request_heads[pull_request_id])}
+    # The patch downloads are independent of each other and of the git work,
+    # so start the ones which will probably be applied now and let them run
+    # while earlier pull requests are being applied. Applying has to stay
+    # serial as it uses the one checkout.
+    with futures.ThreadPoolExecutor(max_workers=8) as executor:
+        patch_futures = {
+            pull_request_id: executor.submit(
+                download_patch, repo_name, pull_request_id, external_path)
+            for pull_request_id in all_open_pull_requests
+            if pull_request_id not in unchanged}
+        for pull_request_id in all_open_pull_requests:
             print()
-            print("Pull Request Handled: ", str(pull_request_id))
+            print("Processing:", str(pull_request_id))
             print('-'*20, flush=True)
-            if label_exists(repo_name, pull_request_id, 'ready-to-merge'):
-                print("PR {0} is now ready to be merged.."
-                      .format(pull_request_id))
-                library_merge_submodules(
-                    pull_request_id, repo_name, access_token)
-        print("Resetting Branches")
-        reset_branches(git_root)
-        print("Reset Branches Done!")
+            commit_hash = pull_request_heads[pull_request_id]
+            print("head commit hash: ", commit_hash)
+            print()
+            # Taken again, as merging an earlier pull request moves the
+            # branches this one is applied to.
+            state = get_pull_request_state(
+                git_root, pull_request_id, commit_hash)
+            statefile = statefiles[pull_request_id]
+            if read_file(statefile) == state:
+                print("Already handled this head commit, not patching.")
+                handled = True
+            else:
+                print("Getting Patch")
+                print()
+                if pull_request_id not in patch_futures:
+                    patch_futures[pull_request_id] = executor.submit(
+                        download_patch, repo_name, pull_request_id,
+                        external_path)
+                patchfile = patch_futures[pull_request_id].result()
+                if patchfile is None:
+                    print('Unable to get patch. Skipping...')
+                    continue
+                print("Will try to apply: ", patchfile)
+
+                handled = library_patch_submodules(
+                    patchfile, pull_request_id, repo_name, access_token,
+                    commit_hash)
+                if handled:
+                    # Taken again, as patching fetched and may have pushed
+                    # new backport branches.
+                    with open(statefile, 'w') as f:
+                        f.write(get_pull_request_state(
+                            git_root, pull_request_id, commit_hash))
+
+            if handled:
+                print()
+                print("Pull Request Handled: ", str(pull_request_id))
+                print('-'*20, flush=True)
+                if 'ready-to-merge' in pull_request_labels[pull_request_id]:
+                    print("PR {0} is now ready to be merged.."
+                          .format(pull_request_id))
+                    library_merge_submodules(
+                        pull_request_id, repo_name, access_token)
+            print("Resetting Branches")
+            reset_branches(git_root)
+            print("Reset Branches Done!")
 
     print('-'*20, flush=True)
     print("Done Creating PR branches!")
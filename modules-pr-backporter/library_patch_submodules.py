@@ -21,8 +21,9 @@ import os
 import subprocess
 import sys
 from library_submodules import git
-from library_submodules import out_v
-from library_submodules import previous_v
+from library_submodules import run
+from library_submodules import DEBUG
+from library_submodules import version_branches
 from library_submodules import get_sequence_number
 from library_submodules import git_issue_comment
 from library_submodules import git_issue_close
@@ -30,12 +31,14 @@ from library_submodules import get_git_root
 from library_submodules import git_fetch
 from library_submodules import get_lib_versions
 from library_submodules import git_clean
+from library_submodules import get_pull_request_branches
+from library_submodules import get_legacy_pull_request_branches
+from library_submodules import GH_PULLREQUEST_NAMESPACE
+from library_submodules import GH_TREE
 
 
 __dir__ = os.path.dirname(__file__)
 
-GH_PULLREQUEST_NAMESPACE = 'backport/{pr_id}/{seq_id}/{branch}'
-
 
 def library_patch_submodules(
         patchfile, pull_request_id, repo_name, access_token, commit_hash):
@@ -50,25 +53,19 @@ def library_patch_submodules(
     git_fetch(git_root)
 
     versions = get_lib_versions(git_root)
+    branches = version_branches(versions)
     failed = True
     apply_idx = 0
-    for i, v in enumerate(versions):
-        pv = previous_v(v, versions)
-        ov = out_v(v, versions)
-
-        v_branch = "branch-{}.{}.{}".format(*ov)
-        v_tag = "v{}.{}.{}".format(*ov)
-
+    # Get us back to a very clean tree.
+    git_clean(git_root)
+    for v, pv, v_branch, v_tag in branches:
         print()
         print("Was:", pv, "Now patching", (v_branch, v_tag), "with", patchfile)
         print('-'*20, flush=True)
 
-        # Get us back to a very clean tree.
-        # git('reset --hard HEAD', git_root)
-        git_clean(git_root)
-
-        # Checkout the right branch
-        git('checkout {0}'.format(v_branch), git_root)
+        # Checkout the right branch, discarding anything left over from an
+        # earlier pull request.
+        git('checkout -f -B {0} origin/{0}'.format(v_branch), git_root)
 
         diff_pos = 'branch-{}.{}.{}'.format(*pv)
 
@@ -92,7 +89,7 @@ def library_patch_submodules(
 
     print('='*75, flush=True)
 
-    old_git_sequence = int(get_sequence_number(pull_request_id))
+    old_git_sequence = get_sequence_number(pull_request_id)
     sequence_increment = 1
     if old_git_sequence != -1:
         old_pr_branch = \
@@ -101,65 +98,63 @@ def library_patch_submodules(
                 seq_id=old_git_sequence,
                 branch='master')
         git('checkout {0}'.format(old_pr_branch), git_root)
-        internal_patch = subprocess.check_output(
-            'git diff {0}..master'.format(old_pr_branch),
-            shell=True).decode('utf-8').strip()
-        print(internal_patch)
-        print('**********************')
-        if not len(internal_patch):
+        diff_range = '{0}..master'.format(old_pr_branch)
+        if DEBUG:
+            run('git diff {0}'.format(diff_range), cwd=git_root)
+        # Exits with 0 when there are no differences and 1 when there are.
+        cmd = ['git', 'diff', '--quiet', diff_range]
+        returncode = subprocess.call(cmd, cwd=git_root)
+        if returncode not in (0, 1):
+            raise subprocess.CalledProcessError(returncode, cmd)
+        if returncode == 0:
             sequence_increment = 0
         print(sequence_increment)
+    if not sequence_increment:
+        # The existing branches already hold exactly this change, pushing
+        # them again would only rewrite them with identical trees.
+        print("Pull Request {0} is unchanged, not pushing."
+              .format(pull_request_id))
+        return True
     git_sequence = old_git_sequence + sequence_increment
 
-    n_branch_links = ""
-    for i, v in enumerate(versions):
-        ov = out_v(v, versions)
-        v_branch = "branch-{}.{}.{}".format(*ov)
-        v_tag = "v{}.{}.{}".format(*ov)
-        print()
-        print("Now Pushing", (v_branch, v_tag))
-        print('-'*20, flush=True)
-
+    tree_url = GH_TREE.format(repo_name)
+    n_branch_links = []
+    refspecs = []
+    for v, pv, v_branch, v_tag in branches:
         n_branch = GH_PULLREQUEST_NAMESPACE.format(
             pr_id=pull_request_id, seq_id=git_sequence, branch=v_branch)
-        branch_link = "https://github.com/{0}/tree/{1}".format(
-            repo_name, n_branch)
-        n_branch_links += "\n- {0}".format(branch_link)
-        print("Now Pushing", n_branch)
-        if git('push -f origin {0}:{1}'.format(v_branch, n_branch),
-                git_root, can_fail=True) is False:
-            print("""\
-Pull Request {0} is coming from a fork and trying to update the workflow. \
-We will skip it!!! \
-""")
-            return False
+        n_branch_links.append("\n- {0}{1}".format(tree_url, n_branch))
+        print("Will push", (v_branch, v_tag), "to", n_branch)
+        refspecs.append('{0}:{1}'.format(v_branch, n_branch))
 
-    print()
     n_branch = GH_PULLREQUEST_NAMESPACE.format(
         pr_id=pull_request_id, seq_id=git_sequence, branch='master')
-    branch_link = "https://github.com/{0}/tree/{1}".format(repo_name, n_branch)
-    n_branch_links += "\n- {0}".format(branch_link)
+    n_branch_links.append("\n- {0}{1}".format(tree_url, n_branch))
+    print("Will push master to", n_branch)
+    refspecs.append('master:{0}'.format(n_branch))
 
-    print("Now Pushing", n_branch)
+    print()
+    print("Now Pushing", len(refspecs), "branches")
     print('-'*20, flush=True)
-    if git('push -f origin master:{0}'.format(n_branch),
+    # A single atomic push updates all the branches over one connection, and
+    # either all of them are updated or none are.
+    if git('push -f --atomic origin {0}'.format(' '.join(refspecs)),
             git_root, can_fail=True) is False:
         print("""\
 Pull Request {0} is coming from a fork and trying to update the workflow. \
 We will skip it!!! \
-""")
+""".format(pull_request_id))
         return False
 
-    if sequence_increment:
-        comment_body = """\
+    comment_body = """\
 The latest commit of this PR, commit {0} has been applied to the branches, \
 please check the links here:
  {1}
-""".format(commit_hash, n_branch_links)
-        git_issue_comment(repo_name,
-                          pull_request_id,
-                          comment_body,
-                          access_token)
+""".format(commit_hash, ''.join(n_branch_links))
+    git_issue_comment(repo_name,
+                      pull_request_id,
+                      comment_body,
+                      access_token)
     return True
 
 
@@ -171,47 +166,31 @@ def library_merge_submodules(pull_request_id, repo_name, access_token):
     git_fetch(git_root)
 
     versions = get_lib_versions(git_root)
-    for i, v in enumerate(versions):
-        pv = previous_v(v, versions)
-        ov = out_v(v, versions)
-
-        v_branch = "branch-{}.{}.{}".format(*ov)
-        v_tag = "v{}.{}.{}".format(*ov)
-        git_sequence = int(get_sequence_number(pull_request_id))
+    git_sequence = get_sequence_number(pull_request_id)
+    refspecs = []
+    for v, pv, v_branch, v_tag in version_branches(versions):
         n_branch = GH_PULLREQUEST_NAMESPACE.format(
             pr_id=pull_request_id, seq_id=git_sequence, branch=v_branch)
-        print()
-        print("Was:", pv, "Now updating", (v_branch, v_tag), "with", n_branch)
-        print('-'*20, flush=True)
-
-        # Get us back to a very clean tree.
-        # git('reset --hard HEAD', git_root)
-        git_clean(git_root)
-
-        # Checkout the right branch
-        git('checkout {0}'.format(v_branch), git_root)
-        print("Now reseting ", v_branch, " to ", n_branch)
-        git('reset --hard origin/{0}'.format(n_branch), git_root)
-        print("Now Pushing", v_branch)
-        git('push -f origin {0}:{0}'.format(v_branch), git_root)
-        for i in range(git_sequence + 1):
-            d_branch = GH_PULLREQUEST_NAMESPACE.format(
-                pr_id=pull_request_id, seq_id=i, branch=v_branch)
-            git('push origin --delete {0}'.format(d_branch),
-                git_root)
+        print("Was:", pv, "Will update", (v_branch, v_tag), "to", n_branch)
+        refspecs.append('origin/{0}:refs/heads/{1}'.format(n_branch, v_branch))
 
-    git_clean(git_root)
     n_branch = GH_PULLREQUEST_NAMESPACE.format(
         pr_id=pull_request_id, seq_id=git_sequence, branch='master')
-    git('checkout master', git_root)
-    print("Now reseting master to ", n_branch)
-    git('reset --hard origin/{0}'.format(n_branch), git_root)
-    print("Now Pushing", v_branch)
-    git('push -f origin master:master', git_root)
-    for i in range(git_sequence + 1):
-        d_branch = GH_PULLREQUEST_NAMESPACE.format(
-            pr_id=pull_request_id, seq_id=i, branch='master')
-        git('push origin --delete {0}'.format(d_branch),
+    print("Will update master to", n_branch)
+    refspecs.append('origin/{0}:refs/heads/master'.format(n_branch))
+
+    print()
+    print("Now Pushing", len(refspecs), "branches")
+    print('-'*20, flush=True)
+    # The pull request branches already hold the final state of every branch,
+    # push them straight from the remote-tracking refs, all or nothing.
+    git('push -f --atomic origin {0}'.format(' '.join(refspecs)), git_root)
+    # Remove the pull request's branches, from every sequence.
+    d_branches = [br for _, br in sorted(
+        get_pull_request_branches().get(str(pull_request_id), []))]
+    if d_branches:
+        print("Now Deleting", len(d_branches), "branches")
+        git('push origin --delete {0}'.format(' '.join(d_branches)),
             git_root)
     git_issue_close(repo_name, pull_request_id, access_token)
     comment_body = """\
@@ -230,13 +209,10 @@ def library_rebase_submodules(pull_request_id):
     git_fetch(git_root)
 
     versions = get_lib_versions(git_root)
-    for i, v in enumerate(versions):
-        pv = previous_v(v, versions)
-        ov = out_v(v, versions)
-
-        v_branch = "branch-{}.{}.{}".format(*ov)
-        v_tag = "v{}.{}.{}".format(*ov)
-        git_sequence = int(get_sequence_number(pull_request_id))
+    git_sequence = get_sequence_number(pull_request_id)
+    # Get us back to a very clean tree.
+    git_clean(git_root)
+    for v, pv, v_branch, v_tag in version_branches(versions):
         n_branch = GH_PULLREQUEST_NAMESPACE.format(
             pr_id=pull_request_id, seq_id=git_sequence, branch=v_branch)
         print()
@@ -245,26 +221,21 @@ def library_rebase_submodules(pull_request_id):
               " with ", (v_branch, v_tag))
         print('-'*20, flush=True)
 
-        # Get us back to a very clean tree.
-        # git('reset --hard HEAD', git_root)
-        git_clean(git_root)
-
         # Checkout the right branch
-        git('checkout {0}'.format(n_branch), git_root)
+        git('checkout -f -B {0} origin/{0}'.format(n_branch), git_root)
         git('rebase origin/{0}'.format(v_branch), git_root)
         print("Now Pushing", n_branch)
         git('push -f origin {0}:{0}'.format(n_branch), git_root)
 
-    git_clean(git_root)
     n_branch = GH_PULLREQUEST_NAMESPACE.format(
         pr_id=pull_request_id, seq_id=git_sequence, branch='master')
-    git('checkout {0}'.format(n_branch), git_root)
+    git('checkout -f -B {0} origin/{0}'.format(n_branch), git_root)
     git('rebase origin/master', git_root)
     print("Now Pushing", n_branch)
     git('push -f origin {0}:{0}'.format(n_branch), git_root)
 
 
-def library_clean_submodules(all_open_pull_requests):
+def library_clean_submodules(all_open_pull_requests, external_path):
     print()
     print()
     print("Cleaning up pull request branches for closed pull requests.")
@@ -272,15 +243,31 @@ def library_clean_submodules(all_open_pull_requests):
 
     git_fetch(git_root)
 
-    all_branches = subprocess.check_output('git branch -r',
-                                           shell=True).decode('utf-8').split()
-    print("All branchs:", all_branches)
-    for br in all_branches:
-        if "origin/pullrequest/temp/" in br \
-                and br.split('/')[3] not in all_open_pull_requests:
+    open_pull_requests = set(all_open_pull_requests)
+    pull_request_branches = get_pull_request_branches()
+    d_branches = []
+    for pr_id, pr_branches in sorted(pull_request_branches.items()):
+        if pr_id in open_pull_requests:
+            continue
+        for seq_id, br in sorted(pr_branches):
+            print('Deleting ', br)
+            d_branches.append(br)
+    for pr_id, pr_branches in sorted(
+            get_legacy_pull_request_branches().items()):
+        if pr_id in open_pull_requests:
+            continue
+        for br in sorted(pr_branches):
             print('Deleting ', br)
-            git('push origin --delete {0}'.format(br.split('origin/', 1)[1]),
-                git_root)
+            d_branches.append(br)
+    if d_branches:
+        git('push origin --delete {0}'.format(' '.join(d_branches)), git_root)
+    # The downloaded patches and recorded states of closed pull requests.
+    for name in sorted(os.listdir(external_path)):
+        pr_id, ext = os.path.splitext(name)
+        if ext in ('.patch', '.state') and pr_id.isdigit() \
+                and pr_id not in open_pull_requests:
+            print('Removing ', name)
+            os.remove(os.path.join(external_path, name))
 
 
 def main(args):
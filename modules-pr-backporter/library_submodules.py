@@ -17,26 +17,132 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import functools
 import os
+import random
+import re
+import shlex
 import subprocess
 import sys
 import time
+import urllib.parse
 import requests
-import json
+
+from concurrent import futures
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+GH_API_REPO = 'https://api.github.com/repos/{0}'
+GH_API_PULLS = GH_API_REPO + '/pulls?state=open&per_page=100'
+GH_API_ISSUE = GH_API_REPO + '/issues/{1}'
+GH_API_ISSUE_COMMENTS = GH_API_ISSUE + '/comments'
+GH_PULL_PATCH = 'https://github.com/{0}/pull/{1}.patch'
+GH_TREE = 'https://github.com/{0}/tree/'
+
+# Shared by all the calls to GitHub, so they reuse the pooled connections.
+# Only idempotent requests are retried, so a comment is never posted twice.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        # Hand back the last response once the retries run out, the callers
+        # check its status themselves.
+        raise_on_status=False)))
+
+# Seconds to wait for GitHub to connect / send data before giving up, rather
+# than hanging the workflow on a stalled connection.
+TIMEOUT = 30
+
+
+# GitHub exports RUNNER_DEBUG=1 when the workflow is re-run with debug logging
+# enabled. ACTIONS_STEP_DEBUG is only seen when the caller exports it.
+DEBUG = any(
+    os.environ.get(name, 'false').lower() in ('true', '1')
+    for name in ('RUNNER_DEBUG', 'ACTIONS_STEP_DEBUG'))
+
+
+def debug(*args, **kw):
+    if DEBUG:
+        print(*args, **kw)
 
 
 def run(cmd, **kw):
-    sys.stdout.flush()
+    # The command's output is written to stdout as it arrives, so whatever is
+    # still buffered has to go out first to keep the log in order.
     sys.stderr.flush()
     print(cmd, '-'*5, flush=True)
-    subprocess.check_call(cmd, shell=True, stderr=subprocess.STDOUT, **kw)
+    p = subprocess.Popen(
+        shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        **kw)
+    # Keep the end of the output, so a failure can be looked at afterwards.
+    tail = b''
+    with p:
+        for chunk in iter(lambda: p.stdout.read1(64 * 1024), b''):
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+            tail = (tail + chunk)[-64 * 1024:]
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd, output=tail)
     print('-'*5, flush=True)
-    sys.stdout.flush()
-    sys.stderr.flush()
 
 
 DATE = None  # 'Mon Oct 06 16:55:02 2020 -0700'
 
+# Failures worth retrying, git's own errors about talking to the remote rather
+# than problems with the command itself (a patch that does not apply, a merge
+# conflict, ...). Only git's `fatal:` / `error:` lines are looked at, so file
+# names or commit messages in the output can not match.
+GIT_TRANSIENT_ERROR_RE = re.compile(
+    rb'(?:^|\r)(?:fatal|error): .*(?:'
+    rb'Could not resolve host|Failed to connect|Connection reset|'
+    rb'Connection refused|Connection timed out|Operation timed out|'
+    rb'early EOF|unexpected disconnect|the remote end hung up|RPC failed|'
+    rb'The requested URL returned error: (?:429|5[0-9][0-9])|'
+    rb'SSL certificate problem|gnutls_handshake|GnuTLS recv error|'
+    rb'SSL_ERROR_|SSL_connect|SSL_read'
+    rb')', re.MULTILINE | re.IGNORECASE)
+
+
+def is_transient_git_error(output):
+    """
+    Returns True if the output of a failed git command shows that talking
+    to the remote failed, so that running it again may work.
+
+    >>> is_transient_git_error(b'fatal: The remote end hung up unexpectedly')
+    True
+    >>> is_transient_git_error(b'error: RPC failed; curl 56 GnuTLS recv error '
+    ...                        b'(-110): The operation timed out')
+    True
+    >>> is_transient_git_error(b"fatal: unable to access 'https://x/': "
+    ...                        b'OpenSSL SSL_read: Connection was reset')
+    True
+    >>> is_transient_git_error(b"fatal: unable to access 'https://x/': "
+    ...                        b'The requested URL returned error: 429')
+    True
+    >>> is_transient_git_error(b"fatal: unable to access 'https://x/': "
+    ...                        b'The requested URL returned error: 503')
+    True
+    >>> is_transient_git_error(b'remote: Counting objects: 1\\r'
+    ...                        b'fatal: early EOF')
+    True
+    >>> is_transient_git_error(b'CONFLICT (content): Merge conflict in '
+    ...                        b'cells/a/a_TLS.v')
+    False
+    >>> is_transient_git_error(b'Applying: Fix SSL cell\\n'
+    ...                        b'error: patch failed: cells/ssl.v:1')
+    False
+    >>> is_transient_git_error(b"fatal: unable to access 'https://x/': "
+    ...                        b'The requested URL returned error: 404')
+    False
+    """
+    return GIT_TRANSIENT_ERROR_RE.search(output) is not None
+
 
 def git(cmd, gitdir, can_fail=False, **kw):
     env = dict(os.environ)
@@ -54,12 +160,15 @@ def git(cmd, gitdir, can_fail=False, **kw):
         try:
             run('git '+cmd, cwd=gitdir, env=env, **kw)
             break
-        except subprocess.CalledProcessError:
+        except subprocess.CalledProcessError as e:
             if can_fail:
                 return False
             i += 1
-            if i < 5:
-                time.sleep(10)
+            if i < 5 and is_transient_git_error(e.output):
+                # Back off exponentially (2, 4, 8, 16s), with some jitter.
+                delay = 2 ** i + random.uniform(0, 1)
+                print("Retrying in {0:.1f}s".format(delay), flush=True)
+                time.sleep(delay)
                 continue
             raise
 
@@ -70,9 +179,14 @@ def out_v(v, versions):
     return v
 
 
+@functools.lru_cache(maxsize=None)
+def out_versions(versions):
+    return ((0, 0, 0),) + tuple(out_v(x, versions) for x in versions)
+
+
 def previous_v(v, versions):
     assert v in versions, (v, versions)
-    vers = [(0, 0, 0)]+[out_v(x, versions) for x in list(versions)]
+    vers = out_versions(tuple(versions))
     ov = out_v(v, versions)
     assert ov in vers, (ov, vers)
     i = vers.index(ov)
@@ -80,80 +194,260 @@ def previous_v(v, versions):
     return vers[i-1]
 
 
+def version_branches(versions):
+    # (version, previous version, branch, tag) for each version.
+    plan = []
+    for v in versions:
+        ov = out_v(v, versions)
+        plan.append((
+            v,
+            previous_v(v, versions),
+            "branch-{}.{}.{}".format(*ov),
+            "v{}.{}.{}".format(*ov),
+        ))
+    return plan
+
+
+GH_PULLREQUEST_PREFIX = 'backport/'
+# Where the pull request branches used to be pushed. Nothing is pushed there
+# any more, the branches are only cleaned up.
+GH_PULLREQUEST_LEGACY_PREFIX = 'pullrequest/temp/'
+GH_PULLREQUEST_NAMESPACE = GH_PULLREQUEST_PREFIX + '{pr_id}/{seq_id}/{branch}'
+
+# Matches the remote tracking branches created from GH_PULLREQUEST_NAMESPACE.
+GH_PULLREQUEST_BRANCH_RE = re.compile(
+    r'^origin/' + re.escape(GH_PULLREQUEST_PREFIX) +
+    r'(?P<pr_id>[0-9]+)/(?P<seq_id>[0-9]+)/(?P<branch>.+)$')
+
+
+def pull_request_branch_info(branch_name):
+    """
+    Parses a remote pull request branch name into
+    (pull request id, sequence number, branch), or None if the name is not
+    a pull request branch.
+
+    >>> pull_request_branch_info('origin/backport/12/3/branch-0.0.1')
+    ('12', 3, 'branch-0.0.1')
+    >>> pull_request_branch_info('origin/branch-0.0.1') is None
+    True
+    """
+    m = GH_PULLREQUEST_BRANCH_RE.match(branch_name)
+    if not m:
+        return None
+    return m.group('pr_id'), int(m.group('seq_id')), m.group('branch')
+
+
 def reset_branches(git_root):
     all_local_branches = subprocess.check_output(
-        'git branch', shell=True).decode('utf-8').split()
+        ['git', 'for-each-ref', '--format=%(refname:short)', 'refs/heads/'],
+        cwd=git_root).decode('utf-8').splitlines()
+    remote_heads = dict(line.split(' ', 1) for line in subprocess.check_output(
+        ['git', 'for-each-ref', '--format=%(refname:lstrip=3) %(objectname)',
+         'refs/remotes/origin/'],
+        cwd=git_root).decode('utf-8').splitlines())
+    # Move all the branches back to the remote state in one `update-ref`
+    # transaction.
+    updates = []
     for branch in all_local_branches:
-        if branch != "*" and not branch.startswith('pullrequest/temp/'):
-            git('checkout {0}'.format(branch), git_root)
-            git('reset --hard origin/{0}'.format(branch), git_root)
+        if branch.startswith(
+                (GH_PULLREQUEST_PREFIX, GH_PULLREQUEST_LEGACY_PREFIX)):
+            continue
+        if branch not in remote_heads:
+            print("Not resetting", branch, "as there is no origin/" + branch)
+            continue
+        updates.append('update refs/heads/{0} {1}\n'.format(
+            branch, remote_heads[branch]))
+    updates = ''.join(updates)
+    print('git update-ref --stdin', '-'*5)
+    print(updates, end='', flush=True)
+    subprocess.run(
+        ['git', 'update-ref', '--stdin'], input=updates.encode(),
+        cwd=git_root, check=True)
+    print('-'*5, flush=True)
+    # The checked out branch may have moved underneath the working tree.
+    git('reset --hard', git_root)
+
+
+# pull request id -> [(sequence number, branch), ...] for every backport
+# branch on the remote. Built from a single listing and thrown away by
+# git_fetch() when the remote-tracking refs change.
+PULL_REQUEST_BRANCHES = None
+
+
+def get_pull_request_branches():
+    global PULL_REQUEST_BRANCHES
+    if PULL_REQUEST_BRANCHES is None:
+        all_branches = subprocess.check_output([
+            'git', 'for-each-ref', '--format=%(refname:lstrip=2)',
+            'refs/remotes/origin/' + GH_PULLREQUEST_PREFIX,
+        ]).decode('utf-8').split()
+        debug("Pull request branches:", all_branches)
+        PULL_REQUEST_BRANCHES = {}
+        for br in all_branches:
+            info = pull_request_branch_info(br)
+            if not info:
+                continue
+            pr_id, seq_id, _ = info
+            PULL_REQUEST_BRANCHES.setdefault(pr_id, []).append(
+                (seq_id, br.split('origin/', 1)[1]))
+    return PULL_REQUEST_BRANCHES
+
+
+def get_legacy_pull_request_branches():
+    all_branches = subprocess.check_output([
+        'git', 'for-each-ref', '--format=%(refname:lstrip=3)',
+        'refs/remotes/origin/' + GH_PULLREQUEST_LEGACY_PREFIX,
+    ]).decode('utf-8').split()
+    legacy_branches = {}
+    for br in all_branches:
+        pr_id = br[len(GH_PULLREQUEST_LEGACY_PREFIX):].split('/', 1)[0]
+        legacy_branches.setdefault(pr_id, []).append(br)
+    return legacy_branches
+
+
+def get_pull_request_state(git_root, pull_request_id, commit_hash):
+    # The pull request's head, the tips of the branches it gets applied on top
+    # of and its existing backport branches.
+    return commit_hash + '\n' + subprocess.check_output([
+        'git', 'for-each-ref', '--format=%(objectname) %(refname)',
+        'refs/remotes/origin/master', 'refs/remotes/origin/branch-*',
+        'refs/remotes/origin/{0}{1}/'.format(
+            GH_PULLREQUEST_PREFIX, pull_request_id),
+    ], cwd=git_root).decode('utf-8')
 
 
 def get_sequence_number(pull_request_id):
-    git_sequence = -1
-    all_branches = subprocess.check_output(
-        'git branch -r', shell=True).decode('utf-8').split()
-    print("All branchs:", all_branches)
-    git_matching_branches = [br for br in all_branches
-                             if "origin/pullrequest/temp/{0}/"
-                                .format(pull_request_id) in br]
-
-    for matching_branch in git_matching_branches:
-        git_sequence = max(int(matching_branch.split("/")[4]), git_sequence)
-    return git_sequence
-
-
-def label_exists(repo_name, pull_request_id, label):
-    r = requests.get(
-        'https://api.github.com/repos/{0}/issues/{1}/labels'.format(
-            repo_name, pull_request_id))
-    for item in r.json():
-        if item['name'] == label:
-            return True
-    return False
+    pr_branches = get_pull_request_branches().get(str(pull_request_id), [])
+    return max((seq_id for seq_id, _ in pr_branches), default=-1)
+
+
+@functools.lru_cache(maxsize=None)
+def github_headers(access_token):
+    return {'Authorization': 'token {0}'.format(access_token)}
+
+
+# Once fewer than this many requests are left, wait for the rate limit to
+# reset instead of running into 403s.
+RATE_LIMIT_RESERVE = 10
+
+
+def wait_for_rate_limit(r):
+    remaining = r.headers.get('X-RateLimit-Remaining')
+    if remaining is None or int(remaining) >= RATE_LIMIT_RESERVE:
+        return
+    delay = int(r.headers.get('X-RateLimit-Reset', 0)) - time.time()
+    if delay > 0:
+        print("Near the GitHub rate limit, waiting {0:.0f}s".format(delay),
+              flush=True)
+        time.sleep(delay)
+
+
+def get_github_page(url, access_token=None):
+    headers = {}
+    if access_token:
+        headers.update(github_headers(access_token))
+    r = SESSION.get(url, headers=headers, timeout=TIMEOUT)
+    wait_for_rate_limit(r)
+    # Fail here, rather than handing an error message to code expecting the
+    # real response.
+    r.raise_for_status()
+    data = r.json()
+    links = {rel: link['url'] for rel, link in r.links.items()}
+    return data, links
+
+
+def github_page_urls(last_url):
+    """
+    Returns the urls of pages 2 up to and including the `rel="last"` page.
+
+    >>> github_page_urls('https://x/pulls?state=open&per_page=100&page=3')
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['https://x/pulls?state=open&per_page=100&page=2',
+     'https://x/pulls?state=open&per_page=100&page=3']
+    """
+    parts = urllib.parse.urlsplit(last_url)
+    query = urllib.parse.parse_qs(parts.query)
+    urls = []
+    for page in range(2, int(query['page'][0]) + 1):
+        query['page'] = [str(page)]
+        urls.append(urllib.parse.urlunsplit(parts._replace(
+            query=urllib.parse.urlencode(query, doseq=True))))
+    return urls
+
+
+def get_github_json_list(url, access_token=None):
+    # List endpoints are paginated. The first page's `rel="last"` link gives
+    # the number of pages, so all the remaining ones are requested at once.
+    items, links = get_github_page(url, access_token)
+    if 'last' in links:
+        with futures.ThreadPoolExecutor(max_workers=4) as executor:
+            for data, _ in executor.map(
+                    lambda u: get_github_page(u, access_token),
+                    github_page_urls(links['last'])):
+                items.extend(data)
+        return items
+    while 'next' in links:
+        data, links = get_github_page(links['next'], access_token)
+        items.extend(data)
+    return items
+
+
+def send_github_json(url, mode, payload, access_token):
+    r = SESSION.request(
+        mode, url, json=payload, headers=github_headers(access_token),
+        timeout=TIMEOUT)
+    wait_for_rate_limit(r)
+    if not r.ok:
+        print("{0} {1} failed: {2} {3}".format(
+            mode, url, r.status_code, r.text[:500]), flush=True)
+    return r
 
 
 def git_issue_comment(repo_name, pull_request_id, body, access_token):
-    url = 'https://api.github.com/repos/{0}/issues/{1}/comments'.format(
-        repo_name, pull_request_id)
+    url = GH_API_ISSUE_COMMENTS.format(repo_name, pull_request_id)
     payload = {'body': body}
-    headers = {'Authorization': 'token {0}'.format(access_token)}
-    requests.post(url, data=json.dumps(payload), headers=headers)
+    send_github_json(url, 'POST', payload, access_token)
 
 
 def git_issue_close(repo_name, pull_request_id, access_token):
-    url = 'https://api.github.com/repos/{0}/issues/{1}'.format(
-        repo_name, pull_request_id)
+    url = GH_API_ISSUE.format(repo_name, pull_request_id)
     payload = {'state': 'closed'}
-    headers = {'Authorization': 'token {0}'.format(access_token)}
-    requests.post(url, data=json.dumps(payload), headers=headers)
+    send_github_json(url, 'PATCH', payload, access_token)
 
 
 def get_git_root():
     return subprocess.check_output(
-        'git rev-parse --show-toplevel', shell=True).decode('utf-8').strip()
+        ['git', 'rev-parse', '--show-toplevel']).decode('utf-8').strip()
 
 
 def git_fetch(git_root):
+    global PULL_REQUEST_BRANCHES
+    PULL_REQUEST_BRANCHES = None
     print()
     print()
-    git('fetch origin', git_root)
-    git('fetch origin --tags', git_root)
+    # `--tags` fetches the tags in addition to the branches, so one fetch is
+    # enough. `--prune` drops branches deleted on the remote, which would
+    # otherwise still be listed by get_pull_request_branches().
+    git('fetch origin --tags --prune', git_root)
     git('status', git_root)
     print('-'*20, flush=True)
 
 
 def get_lib_versions(git_root):
-    tags = subprocess.check_output('git tag -l', shell=True, cwd=git_root)
+    tags = subprocess.check_output([
+        'git', 'for-each-ref', '--format=%(refname:lstrip=2)', 'refs/tags/v*',
+    ], cwd=git_root)
 
     tags = tags.decode('utf-8')
 
-    versions = [tuple(int(i) for i in v[1:].split('.')) for v in tags.split()]
+    # Sort numerically, so that v0.10.0 comes after v0.2.0.
+    versions = sorted(
+        tuple(int(i) for i in v[1:].split('.')) for v in tags.split())
     if (0, 0, 0) in versions:
         versions.remove((0, 0, 0))
-    return versions
+    return tuple(versions)
 
 
 def git_clean(git_root):
-    git('clean -f', git_root)
+    # `-x` removes the ignored files as well as everything `clean -f` would.
     git('clean -x -f', git_root)
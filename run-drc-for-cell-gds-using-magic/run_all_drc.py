@@ -36,15 +36,18 @@ import subprocess
 import traceback
 
 from concurrent import futures
-from typing import List, Tuple
+from typing import Collection, List, Tuple
 
 import click
 
-acceptable_errors = []
+acceptable_errors = frozenset()
 
 SCRIPT_DIR = os.path.realpath(os.path.dirname(__file__))
 STANDARD_DRC_SCRIPT = os.path.join(SCRIPT_DIR, "run_standard_drc.py")
 PDK_SUBSET = os.getenv("PDK_ROOT") or os.path.join(SCRIPT_DIR, "sky130A")
+DEBUG = any(
+    os.getenv(name, "false").lower() in ("true", "1")
+    for name in ("RUNNER_DEBUG", "ACTIONS_STEP_DEBUG"))
 
 DRCError = Tuple[str, List[str]]
 
@@ -69,7 +72,7 @@ It has less lines of detail.
 
 
 def parse_drc_report(
-        report: str, acceptable_errors: List[str]) -> List[DRCError]:
+        report: str, acceptable_errors: Collection[str]) -> List[DRCError]:
     """
     Takes a magic report in the format as seen in PARSE_DRC_REPORT_EXAMPLE
     above, and returns all errors as a list of tuples, where the first element
@@ -84,16 +87,14 @@ def parse_drc_report(
        'There are usually a couple of lines.']),
      ('This is another unacceptable error.', ['It has less lines of detail.'])]
     """
-    components = [x.split("\n") for x in report.split("\n\n")]
     errors = []
 
-    header = components.pop(0)  # noqa: F841
-
-    for error in components:
-        error_name = error[0]
+    # The first block is the header.
+    for block in report.split("\n\n")[1:]:
+        error_name, newline, details = block.partition("\n")
         if error_name in acceptable_errors:
             continue
-        errors.append((error[0], error[1:]))
+        errors.append((error_name, details.split("\n") if newline else []))
 
     return errors
 
@@ -116,9 +117,10 @@ def drc_gds(path: str) -> Tuple[str, List[DRCError]]:
 
     report_path = path[:-4] + "_drc.txt"
     try:
-        report = open(report_path).read()
+        with open(report_path) as f:
+            report = f.read()
 
-        if os.getenv("ACTIONS_STEP_DEBUG") or False:
+        if DEBUG:
             print("::group::%s" % report_path)
             print(report)
             print("::endgroup::")
@@ -160,8 +162,10 @@ def run_all_drc(acceptable_errors_file, match_directories, known_bad):
     print("Testing cells in directories matching /%s/…" % match_directories)
 
     global acceptable_errors
-    acceptable_errors_str = open(acceptable_errors_file).read()
-    acceptable_errors = acceptable_errors_str.split("\n")
+    with open(acceptable_errors_file) as f:
+        acceptable_errors_str = f.read()
+    # Every error of every cell is checked against this, so make it a set.
+    acceptable_errors = frozenset(acceptable_errors_str.split("\n"))
 
     known_bad_list = known_bad.split(",")
 